@@ -1,11 +1,13 @@
 # auto_select_stock.py
 import os
-import struct
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
+import matplotlib
+matplotlib.use("Agg")  # 只输出 PNG，无需探测 GUI 后端
 import matplotlib.pyplot as plt
+from numpy.lib.stride_tricks import sliding_window_view
 from tqdm import tqdm
-from datetime import datetime, timedelta
 
 # 配置
 TDX_DATA_DIR = "tdx_data"
@@ -18,89 +20,150 @@ MIN_LIST_DAYS = 30  # 上市天数
 N1 = 9
 N2 = 10
 N3 = 20
+MIN_BARS = max(N1 + 1, N2, N3)  # 三个指标都有值所需的最少 K 线数
+
+# 通达信 .day 记录：日期、开高低收（单位：分）、成交额、成交量、保留，每条 32 字节
+DAY_DTYPE = np.dtype([
+    ("date", "<u4"), ("open", "<u4"), ("high", "<u4"), ("low", "<u4"),
+    ("close", "<u4"), ("amount", "<f4"), ("vol", "<u4"), ("reserved", "<u4"),
+])
+MIN_FILE_SIZE = MIN_BARS * DAY_DTYPE.itemsize  # 含 MIN_BARS 条记录所需的最小文件字节数
 
 def read_day_file(file_path):
-    """解析通达信 .day 文件"""
+    """解析通达信 .day 文件，返回 (日期, 最高, 最低, 收盘) 数组"""
     try:
-        with open(file_path, "rb") as f:
-            buf = f.read()
-        record_size = 32
-        num_records = len(buf) // record_size
-        data = []
-        for i in range(num_records):
-            offset = i * record_size
-            r = struct.unpack("<IIIIIfII", buf[offset:offset+record_size])
-            date = r[0]
-            y = date // 10000
-            m = (date % 10000) // 100
-            d = date % 100
-            close = r[3] / 100
-            high = r[1] / 100
-            low = r[2] / 100
-            openp = r[4] / 100
-            vol = r[5]
-            data.append([datetime(y, m, d), openp, high, low, close, vol])
-        df = pd.DataFrame(data, columns=["日期","开盘","最高","最低","收盘","成交量"])
-        df.sort_values("日期", inplace=True)
-        df.reset_index(drop=True, inplace=True)
-        return df
+        arr = np.fromfile(file_path, dtype=DAY_DTYPE)
+        # 通达信按日期顺序写入记录，只有异常文件才需要排序
+        if (arr["date"][1:] < arr["date"][:-1]).any():
+            arr = arr[np.argsort(arr["date"], kind="stable")]
+        raw = arr["date"].astype(np.int64)
+        y, m, d = raw // 10000, raw // 100 % 100, raw % 100
+        # A 股 1990 年开市，超出合理年份区间（如 0000 年）的记录视为损坏
+        if not ((y >= 1990) & (y <= 2100) & (m >= 1) & (m <= 12) & (d >= 1) & (d <= 31)).all():
+            raise ValueError("日期字段非法")
+        # 用整数运算直接拼出 datetime64，避免逐条解析日期字符串
+        months = ((y - 1970) * 12 + m - 1).astype("M8[M]")
+        dates = months.astype("M8[D]") + (d - 1).astype("m8[D]")
+        # 2 月 30 日之类的日期会顺延到下个月，回查月份即可识别
+        if not (dates.astype("M8[M]") == months).all():
+            raise ValueError("日期字段非法")
+        # 只取选股用到的字段，直接返回 ndarray，省去构造 DataFrame 的开销
+        return dates, arr["high"] / 100, arr["low"] / 100, arr["close"] / 100
     except Exception as e:
         print(f"[错误] 解析 {file_path} 失败: {e}")
         return None
 
+def iter_day_files(data_dir):
+    """递归遍历目录，产出 (代码, 路径)；顺序与 os.walk 一致：先本层文件，再逐个子目录"""
+    sub_dirs = []
+    try:
+        entries = os.scandir(data_dir)
+    except OSError:
+        # 与 os.walk 默认行为一致：无法读取的目录直接跳过
+        return
+    with entries:
+        for entry in entries:
+            if entry.is_dir():
+                if not entry.is_symlink():
+                    sub_dirs.append(entry.path)
+            elif entry.name.endswith(".day"):
+                yield entry.name[:-4], entry.path
+    for sub_dir in sub_dirs:
+        yield from iter_day_files(sub_dir)
+
 def get_all_stocks(data_dir=TDX_DATA_DIR):
     """扫描 tdx_data 目录下所有 .day 文件"""
-    stocks = {}
-    for root, _, files in os.walk(data_dir):
-        for f in files:
-            if f.endswith(".day"):
-                code = os.path.splitext(f)[0]
-                stocks[code] = os.path.join(root, f)
-    return stocks
-
-def calc_rsi_wr(df):
-    LC = df["收盘"].shift(1)
-    delta = df["收盘"] - LC
-    delta_up = delta.clip(lower=0)
-    delta_abs = delta.abs()
-    rsi = delta_up.rolling(N1).mean() / delta_abs.rolling(N1).mean() * 100
-    hhv_high_N2 = df["最高"].rolling(N2).max()
-    llv_low_N2 = df["最低"].rolling(N2).min()
-    hhv_high_N3 = df["最高"].rolling(N3).max()
-    llv_low_N3 = df["最低"].rolling(N3).min()
-    wr1 = 100*(hhv_high_N2 - df["收盘"])/(hhv_high_N2 - llv_low_N2)
-    wr2 = 100*(hhv_high_N3 - df["收盘"])/(hhv_high_N3 - llv_low_N3)
-    df["RSI"] = rsi
-    df["WR1"] = wr1
-    df["WR2"] = wr2
-    return df
+    if not os.path.isdir(data_dir):
+        return {}
+    return dict(iter_day_files(data_dir))
+
+def rolling_window(a, n, func):
+    """对 ndarray 做长度为 n 的滚动聚合，窗口不足的位置为 NaN"""
+    out = np.full(len(a), np.nan)
+    if len(a) >= n:
+        out[n-1:] = func(sliding_window_view(a, n), axis=-1)
+    return out
+
+def widen_window(rolled, k, func):
+    """由长度 n 的滚动 max/min 结果得到长度 n+k 的结果（要求 0 < k <= n）"""
+    out = np.full(len(rolled), np.nan)
+    out[k:] = func(rolled[k:], rolled[:-k])
+    return out
+
+def rsi_above_70(close):
+    """逐根判断 RSI(N1) > 70；按整数分精确计算，RSI 恰为 70 时不会被浮点误差误判"""
+    # .day 价格本就是整数分，乘回 100 取整即可无损还原
+    cents = np.rint(close * 100).astype(np.int64)
+    out = np.zeros(len(cents), dtype=bool)
+    if len(cents) > N1:
+        # 窗口内涨跌之和由收盘价首尾相减得到；上涨之和 = (涨跌之和 + 涨跌幅绝对值之和) / 2
+        delta_sum = cents[N1:] - cents[:-N1]
+        abs_sum = sliding_window_view(np.abs(np.diff(cents)), N1).sum(axis=-1)
+        # RSI = (delta_sum / abs_sum + 1) * 50 > 70  ⇔  5 * delta_sum > 2 * abs_sum；全平窗口 RSI 无值
+        out[N1:] = (abs_sum > 0) & (5 * delta_sum > 2 * abs_sum)
+    return out
+
+def calc_wr(close, high, low):
+    """直接在 ndarray 上计算 WR1 / WR2，避免逐个 pandas 算子的调度开销"""
+    hhv_high_N2 = rolling_window(high, N2, np.max)
+    llv_low_N2 = rolling_window(low, N2, np.min)
+    if N2 < N3 <= 2 * N2:
+        # N3 窗口恰好被当前和前移 N3-N2 根的两个 N2 窗口覆盖，直接复用
+        hhv_high_N3 = widen_window(hhv_high_N2, N3 - N2, np.maximum)
+        llv_low_N3 = widen_window(llv_low_N2, N3 - N2, np.minimum)
+    else:
+        hhv_high_N3 = rolling_window(high, N3, np.max)
+        llv_low_N3 = rolling_window(low, N3, np.min)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        wr1 = 100*(hhv_high_N2 - close)/(hhv_high_N2 - llv_low_N2)
+        wr2 = 100*(hhv_high_N3 - close)/(hhv_high_N3 - llv_low_N3)
+    return wr1, wr2
+
+def select_mask(close, high, low):
+    """逐根 K 线的选股条件：RSI > 70 且 WR1、WR2 均 < 20"""
+    wr1, wr2 = calc_wr(close, high, low)
+    return rsi_above_70(close) & (wr1 < 20) & (wr2 < 20)
+
+def load_stock(item):
+    """读取单只股票，返回被选中 K 线的日期、收盘数组（进程池任务，需定义在模块顶层）"""
+    code, file_path = item
+    # K 线不足时指标全为 NaN，不可能被选中；按文件大小即可判断，不必解析
+    try:
+        file_size = os.path.getsize(file_path)
+    except OSError as e:
+        # 坏链接或扫描后被删除的文件：与解析失败一样报错跳过，不能让异常中断整个进程池
+        print(f"[错误] 解析 {file_path} 失败: {e}")
+        return code, None, None
+    if file_size < MIN_FILE_SIZE:
+        return code, None, None
+    bars = read_day_file(file_path)
+    if bars is None or len(bars[0]) < MIN_BARS:
+        return code, None, None
+    dates, high, low, close = bars
+    # read_day_file 保证日期升序，首尾两根即为上市区间
+    if (dates[-1] - dates[0]).astype(np.int64) < MIN_LIST_DAYS:
+        return code, None, None
+    # 只回传 ndarray，跨进程序列化比 DataFrame 轻得多
+    mask = select_mask(close, high, low)
+    # 同一日期有重复记录时只看第一条，保证每只股票每天最多计一次
+    mask[1:] &= dates[1:] != dates[:-1]
+    return code, dates[mask], close[mask]
 
 def daily_selected_count(stocks):
-    """统计每日选股数量"""
-    all_dates = set()
-    dfs = {}
-    for code, file_path in tqdm(stocks.items(), desc="读取股票数据"):
-        df = read_day_file(file_path)
-        if df is None or df.empty:
-            continue
-        if (df["日期"].max() - df["日期"].min()).days < MIN_LIST_DAYS:
-            continue
-        df = calc_rsi_wr(df)
-        dfs[code] = df
-        all_dates.update(df["日期"])
-    all_dates = sorted(all_dates)
-    date_counts = {}
-    for date in tqdm(all_dates, desc="统计每日选股数量"):
-        count = 0
-        for code, df in dfs.items():
-            row = df[df["日期"] == date]
-            if not row.empty:
-                r = row.iloc[0]
-                if r["RSI"] > 70 and r["WR1"] < 20 and r["WR2"] < 20:
-                    count += 1
-        if count > 0:
-            date_counts[date] = count
-    return date_counts
+    """统计每日选股数量，同时返回各股票被选中 K 线的 (日期, 收盘) 数组"""
+    selected = {}
+    # 解析 + 指标计算是 CPU 密集型，按文件分发到多进程
+    with ProcessPoolExecutor() as executor:
+        results = executor.map(load_stock, stocks.items(), chunksize=64)
+        for code, dates, closes in tqdm(results, total=len(stocks), desc="读取股票数据"):
+            if dates is not None and len(dates):
+                selected[code] = (dates, closes)
+    if not selected:
+        return {}, selected
+    # 所有选中记录的日期拼在一起，一次 value_counts 得到每日数量
+    all_dates = pd.Series(np.concatenate([dates for dates, _ in selected.values()]))
+    date_counts = all_dates.value_counts().sort_index()
+    return date_counts.to_dict(), selected
 
 def main():
     print("[INFO] 开始运行自动选股程序")
@@ -110,7 +173,7 @@ def main():
         print("[错误] 没有找到任何 .day 文件，直接退出")
         return
 
-    date_counts = daily_selected_count(stocks)
+    date_counts, selected = daily_selected_count(stocks)
     if not date_counts:
         print("[INFO] 没有任何日期选出股票")
         return
@@ -120,32 +183,24 @@ def main():
     df_count.to_csv(OUTPUT_DAILY_COUNT_CSV, index=False, encoding="utf-8-sig")
     print(f"[INFO] 生成每日选股数量 CSV → {OUTPUT_DAILY_COUNT_CSV}")
 
-    # 保存最新一天的选中股票 CSV
+    # 保存最新一天的选中股票 CSV（直接复用统计时的结果，不再重新读取文件）
     latest_date = max(date_counts.keys())
     selected_latest = {}
-    for code, file_path in stocks.items():
-        df = read_day_file(file_path)
-        if df is None or df.empty:
-            continue
-        if (df["日期"].max() - df["日期"].min()).days < MIN_LIST_DAYS:
-            continue
-        df = calc_rsi_wr(df)
-        row = df[df["日期"] == latest_date]
-        if not row.empty:
-            r = row.iloc[0]
-            if r["RSI"] > 70 and r["WR1"] < 20 and r["WR2"] < 20:
-                selected_latest[code] = r["收盘"]
+    for code, (dates, closes) in selected.items():
+        if dates[-1] == latest_date:
+            selected_latest[code] = closes[-1]
     df_latest = pd.DataFrame(list(selected_latest.items()), columns=["代码","收盘"])
     df_latest.to_csv(OUTPUT_CSV, index=False, encoding="utf-8-sig")
     print(f"[INFO] 生成最新选股 CSV → {OUTPUT_CSV}")
 
     # 绘制折线图（休市日自动跳过）
-    plt.figure(figsize=(12,6))
-    df_count.set_index("日期")["选中数量"].plot(kind="line", marker="o", title="每日选股数量")
-    plt.ylabel("选中数量")
-    plt.xlabel("日期")
-    plt.tight_layout()
-    plt.savefig(OUTPUT_PNG)
+    fig, ax = plt.subplots(figsize=(12,6))
+    df_count.set_index("日期")["选中数量"].plot(ax=ax, kind="line", marker="o", title="每日选股数量")
+    ax.set_ylabel("选中数量")
+    ax.set_xlabel("日期")
+    fig.tight_layout()
+    fig.savefig(OUTPUT_PNG)
+    plt.close(fig)
     print(f"[INFO] 生成折线图 → {OUTPUT_PNG}")
 
 if __name__ == "__main__":